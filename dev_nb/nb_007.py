@@ -10,19 +10,23 @@ from collections import Counter
 class LanguageModelLoader():
     "Creates a dataloader with bptt slightly changing."
 
-    def __init__(self, nums:np.ndarray, bs:int=64, bptt:int=70, backwards:bool=False):
+    def __init__(self, nums:np.ndarray, bs:int=64, bptt:int=70, backwards:bool=False, device:torch.device=None):
         self.bs,self.bptt,self.backwards = bs,bptt,backwards
+        #Batches stay on the CPU for the DataBunch to move, unless a device is given here.
+        self.device = None if device is None else torch.device(device)
         self.data = self.batchify(nums)
         self.first,self.i,self.iter = True,0,0
         self.n = len(self.data)
+        #Few distinct seq_len so that cuDNN plans and CUDA graphs can be reused.
+        self.buckets = sorted({max(5, int(round(bptt*r))) for r in (0.5,0.7,0.85,1.,1.1,1.25)})
 
     def __iter__(self):
         self.i,self.iter = 0,0
+        seq_lens = self.sample_seq_lens(len(self))
         while self.i < self.n-1 and self.iter<len(self):
-            if self.first and self.i == 0: self.first,seq_len = False,self.bptt + 25
-            else:
-                bptt = self.bptt if np.random.random() < 0.95 else self.bptt / 2.
-                seq_len = max(5, int(np.random.normal(bptt, 5)))
+            #Longest bucket first, so the largest buffers are allocated once.
+            if self.first and self.i == 0: self.first,seq_len = False,self.buckets[-1]
+            else: seq_len = int(seq_lens[self.iter])
             res = self.get_batch(self.i, seq_len)
             self.i += seq_len
             self.iter += 1
@@ -30,33 +34,67 @@ class LanguageModelLoader():
 
     def __len__(self) -> int: return (self.n-1) // self.bptt
 
-    def batchify(self, data:np.ndarray) -> LongTensor:
+    def sample_seq_lens(self, n:int) -> np.ndarray:
+        "Draws `n` seq_len around bptt (bptt/2 5% of the time) at once, snapped to the closest bucket."
+        bptt = np.where(np.random.random(n) < 0.95, self.bptt, self.bptt / 2.)
+        seq_lens = np.maximum(5, np.random.normal(bptt, 5).astype(int))
+        buckets = np.array(self.buckets)
+        return buckets[np.abs(seq_lens[:,None] - buckets[None]).argmin(1)]
+
+    def batchify(self, data:np.ndarray) -> Tensor:
         "Splits the data in batches."
         nb = data.shape[0] // self.bs
-        data = np.array(data[:nb*self.bs]).reshape(self.bs, -1).T
+        data = data[:nb*self.bs].reshape(self.bs, -1).T
         if self.backwards: data=data[::-1]
-        return LongTensor(data)
-
-    def get_batch(self, i:int, seq_len:int) -> LongTensor:
-        "Gets a batch of length `seq_len`"
+        #Only one copy to a contiguous array, that torch then shares.
+        if self.device is None or self.device.type != 'cuda':
+            return torch.from_numpy(np.ascontiguousarray(data, dtype=np.int64))
+        #int32 halves the host to device traffic, batches are cast to int64 once on the device.
+        return torch.from_numpy(np.ascontiguousarray(data, dtype=np.int32)).pin_memory()
+
+    def get_batch(self, i:int, seq_len:int) -> Tuple[LongTensor,LongTensor]:
+        "Gets a batch of length `seq_len`, sent asynchronously to `self.device` if there is one"
         seq_len = min(seq_len, len(self.data) - 1 - i)
-        return self.data[i:i+seq_len], self.data[i+1:i+1+seq_len].contiguous().view(-1)
+        x,y = self.data[i:i+seq_len], self.data[i+1:i+1+seq_len].contiguous().view(-1)
+        if self.device is None: return x, y
+        return x.to(self.device, non_blocking=True).long(), y.to(self.device, non_blocking=True).long()
+
+def dropout_mask(x:Tensor, sz:Collection[int], p:float, buf:Optional[Tensor]=None):
+    "Returns a dropout mask of the same type as x, size sz, with probability p to cancel an element. Refills `buf` if it fits."
+    if buf is None or buf.size() != torch.Size(sz) or buf.dtype != x.dtype or buf.device != x.device: buf = x.new(*sz)
+    return buf.bernoulli_(1-p).div_(1-p)
+
+class MaskBuffer():
+    "Keeps a dropout mask to refill in place, unless autograd still needs its previous values."
 
-def dropout_mask(x:Tensor, sz:Collection[int], p:float):
-    "Returns a dropout mask of the same type as x, size sz, with probability p to cancel an element."
-    return x.new(*sz).bernoulli_(1-p).div_(1-p)
+    def __init__(self): self.mask,self.busy = None,False
+
+    def fill(self, x:Tensor, sz:Collection[int], p:float) -> Tensor:
+        "Draws a new mask (see `dropout_mask`) in the same memory as the last one when possible."
+        self.mask = dropout_mask(x, sz, p, None if self.busy else self.mask)
+        return self.mask
+
+    def hold(self, res:Tensor) -> Tensor:
+        "Keeps the current mask from being refilled until the gradient of `res` is computed."
+        if res.requires_grad:
+            mask,self.busy = self.mask,True
+            res.register_hook(lambda g: self.free(mask))
+        return res
+
+    def free(self, mask:Tensor):
+        if mask is self.mask: self.busy = False
 
 class RNNDropout(nn.Module):
     "Dropout that is consistent on the seq_len dimension"
 
     def __init__(self, p:float=0.5):
         super().__init__()
-        self.p=p
+        self.p,self.mask_buf = p,MaskBuffer()
 
     def forward(self, x:Tensor) -> Tensor:
         if not self.training or self.p == 0.: return x
-        m = dropout_mask(x.data, (1, x.size(1), x.size(2)), self.p)
-        return x * m
+        m = self.mask_buf.fill(x.data, (1, x.size(1), x.size(2)), self.p)
+        return self.mask_buf.hold(x * m)
 
 import warnings
 
@@ -75,7 +113,9 @@ class WeightDropout(nn.Module):
         "Applies dropout to the raw weights"
         for layer in self.layer_names:
             raw_w = getattr(self, f'{layer}_raw')
-            self.module._parameters[layer] = F.dropout(raw_w, p=self.weight_p, training=self.training)
+            if self.training and self.weight_p != 0.:
+                self.module._parameters[layer] = F.dropout(raw_w, p=self.weight_p, training=True)
+            else: self.module._parameters[layer] = raw_w
 
     def forward(self, *args:ArgStar):
         self._setweights()
@@ -97,19 +137,34 @@ class EmbeddingDropout(nn.Module):
         if self.pad_idx is None: self.pad_idx = -1
 
     def forward(self, words:LongTensor, scale:Optional[float]=None) -> Tensor:
+        pad_idx = self.pad_idx
         if self.training and self.embed_p != 0:
-            size = (self.emb.weight.size(0),1)
-            mask = dropout_mask(self.emb.weight.data, size, self.embed_p)
-            masked_embed = self.emb.weight * mask
+            #Only the rows used by this batch are masked, then words are looked up in that smaller matrix.
+            rows,words = torch.unique(words, return_inverse=True)
+            mask = dropout_mask(self.emb.weight.data, (rows.size(0),1), self.embed_p)
+            masked_embed = self.emb.weight[rows] * mask
+            #unique already synced with the CPU (its size depends on the data), so reading the pad row back is free.
+            pad_pos = (rows == self.pad_idx % self.emb.weight.size(0)).nonzero()
+            pad_idx = pad_pos[0,0].item() if len(pad_pos) else None
         else: masked_embed = self.emb.weight
         if scale: masked_embed.mul_(scale)
-        return F.embedding(words, masked_embed, self.pad_idx, self.emb.max_norm,
+        return F.embedding(words, masked_embed, pad_idx, self.emb.max_norm,
                            self.emb.norm_type, self.emb.scale_grad_by_freq, self.emb.sparse)
 
 def repackage_var(h:Tensors) -> Tensors:
     "Detaches h from its history."
     return h.detach() if type(h) == torch.Tensor else tuple(repackage_var(v) for v in h)
 
+def clone_hidden(h:Tensors) -> Tensors:
+    "Clones the hidden state `h`."
+    return h.clone() if type(h) == torch.Tensor else tuple(clone_hidden(v) for v in h)
+
+def copy_hidden(dst:Tensors, src:Tensors):
+    "Copies the hidden state `src` in `dst`, in place."
+    if type(dst) != torch.Tensor:
+        for d,s in zip(dst, src): copy_hidden(d, s)
+    elif dst is not src: dst.copy_(src)
+
 class RNNCore(nn.Module):
     "AWD-LSTM/QRNN inspired by https://arxiv.org/abs/1708.02182"
 
@@ -154,20 +209,85 @@ class RNNCore(nn.Module):
             raw_outputs.append(raw_output)
             if l != self.n_layers - 1: raw_output = hid_dp(raw_output)
             outputs.append(raw_output)
-        self.hidden = repackage_var(new_hidden)
+        #Autograd needs the old hidden states for backward, without it we update them in place to keep their memory.
+        if torch.is_grad_enabled(): self.hidden = repackage_var(new_hidden)
+        else: copy_hidden(self.hidden, new_hidden)
         return raw_outputs, outputs
 
-    def one_hidden(self, l:int) -> Tensor:
-        "Returns one hidden state"
+    def one_hidden(self, l:int, h:Optional[Tensor]=None) -> Tensor:
+        "Returns one hidden state, zeroing `h` in place if autograd is off and it has the right size"
         nh = (self.n_hid if l != self.n_layers - 1 else self.emb_sz)//self.ndir
+        if (h is not None and not torch.is_grad_enabled() and h.size() == (self.ndir, self.bs, nh)
+            and h.dtype == self.weights.dtype and h.device == self.weights.device): return h.zero_()
         return self.weights.new(self.ndir, self.bs, nh).zero_()
 
     def reset(self):
         "Resets the hidden states"
-        [r.reset() for r in self.rnns if hasattr(r, 'reset')]
+        for r in self.rnns:
+            reset = getattr(r, 'reset', None)
+            if reset is not None: reset()
         self.weights = next(self.parameters()).data
-        if self.qrnn: self.hidden = [self.one_hidden(l) for l in range(self.n_layers)]
-        else: self.hidden = [(self.one_hidden(l), self.one_hidden(l)) for l in range(self.n_layers)]
+        old = getattr(self, 'hidden', None) or [None if self.qrnn else (None,None)] * self.n_layers
+        if self.qrnn: self.hidden = [self.one_hidden(l, h) for l,h in enumerate(old)]
+        else: self.hidden = [(self.one_hidden(l, h), self.one_hidden(l, c)) for l,(h,c) in enumerate(old)]
+
+class RNNCoreGraphed(nn.Module):
+    "Replays the inference forward of `core` from CUDA graphs cached by `(seq_len, bs, dtype, device)`."
+
+    def __init__(self, core:RNNCore, n_warmup:int=3):
+        super().__init__()
+        self.core,self.n_warmup,self.graphs = core,n_warmup,{}
+
+    def can_graph(self, input:LongTensor) -> bool:
+        "Checks if the forward on `input` can be replayed from a CUDA graph."
+        return (hasattr(torch.cuda, 'CUDAGraph') and input.is_cuda and not self.training
+                and not torch.is_grad_enabled() and not self.core.qrnn)
+
+    def capture(self, input:LongTensor) -> Tuple:
+        "Records the forward of `self.core` on `input` in a new CUDA graph."
+        hidden = self.core.hidden
+        static_input,static_hidden = input.clone(),clone_hidden(hidden)
+        #Warmup on a side stream so the lazy initializations aren't captured.
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(self.n_warmup):
+                self.core.hidden = clone_hidden(static_hidden)
+                self.core(static_input)
+        torch.cuda.current_stream().wait_stream(s)
+        graph = torch.cuda.CUDAGraph()
+        self.core.hidden = static_hidden
+        with torch.cuda.graph(graph): static_output = self.core(static_input)
+        #The forward updated static_hidden in place.
+        self.core.hidden = hidden
+        return graph,static_input,static_hidden,static_output
+
+    def clear_graphs(self):
+        "Drops the recorded graphs, which point to the memory of the weights at capture time."
+        self.graphs = {}
+
+    def _apply(self, fn):
+        #`half`, `to`, `cuda`... go through here and may move the weights the graphs read.
+        self.clear_graphs()
+        return super()._apply(fn)
+
+    def forward(self, input:LongTensor) -> Tuple[Tensor,Tensor]:
+        if not self.can_graph(input): return self.core(input)
+        sl,bs = input.size()
+        if bs!=self.core.bs:
+            self.core.bs=bs
+            self.core.reset()
+        w = next(self.core.parameters())
+        key = (sl,bs,w.dtype,w.device)
+        if key not in self.graphs: self.graphs[key] = self.capture(input)
+        graph,static_input,static_hidden,static_output = self.graphs[key]
+        static_input.copy_(input)
+        copy_hidden(static_hidden, self.core.hidden)
+        graph.replay()
+        self.core.hidden = static_hidden
+        return static_output
+
+    def reset(self): self.core.reset()
 
 class LinearDecoder(nn.Module):
     "To go on top of a RNN_Core module"
@@ -185,14 +305,16 @@ class LinearDecoder(nn.Module):
     def forward(self, input:Tuple[Tensor,Tensor]) -> Tuple[Tensor,Tensor,Tensor]:
         raw_outputs, outputs = input
         output = self.output_dp(outputs[-1])
-        decoded = self.decoder(output.view(output.size(0)*output.size(1), output.size(2)))
+        #Flattening is free on the contiguous output and keeps F.linear on its fused addmm path (2D input only).
+        decoded = self.decoder(output.view(-1, output.size(2)))
         return decoded, raw_outputs, outputs
 
 class SequentialRNN(nn.Sequential):
     "A sequential module that passes the reset call to its children."
     def reset(self):
         for c in self.children():
-            if hasattr(c, 'reset'): c.reset()
+            reset = getattr(c, 'reset', None)
+            if reset is not None: reset()
 
 def get_language_model(vocab_sz:int, emb_sz:int, n_hid:int, n_layers:int, pad_token:int, tie_weights:bool=True,
                        qrnn:bool=False, bias:bool=True, output_p:float=0.4, hidden_p:float=0.2, input_p:float=0.6,
@@ -210,7 +332,18 @@ class GradientClipping(Callback):
     clip:float
 
     def on_backward_end(self, **kwargs):
-        if self.clip:  nn.utils.clip_grad_norm_(self.learn.model.parameters(), self.clip)
+        if not self.clip: return
+        #Same as nn.utils.clip_grad_norm_ but the norm stays on the device, so there is no sync with the CPU.
+        grads = [p.grad.detach() for p in self.learn.model.parameters() if p.grad is not None]
+        if len(grads) == 0: return
+        total_norm = torch.stack([g.norm() for g in grads]).norm()
+        clip_coef = (self.clip / (total_norm + 1e-6)).clamp_(max=1.)
+        for g in grads: g.mul_(clip_coef)
+
+@torch.jit.script
+def seq_diff_sq_mean(h:Tensor) -> Tensor:
+    "Mean of the squared differences between consecutive time steps of `h`. Scripted so the sub/pow may fuse on GPU."
+    return (h[1:] - h[:-1]).pow(2).mean()
 
 @dataclass
 class RNNTrainer(Callback):
@@ -227,11 +360,19 @@ class RNNTrainer(Callback):
         return last_output[0]
 
     def on_backward_begin(self, last_loss:Rank0Tensor, last_input:Tensor, last_output:Tensor, **kwargs):
-        #Adjusts the lr to the bptt selected
-        if self.adjust: self.learn.opt.lr *= last_input.size(0) / self.bptt
         #AR and TAR
-        if self.alpha != 0.:  last_loss += (self.alpha * self.out[-1].pow(2).mean()).sum()
+        if self.alpha != 0.:
+            #Scaling before squaring keeps the sum of squares out of fp16 range.
+            out = self.out[-1]
+            last_loss += self.alpha * (out.norm() / math.sqrt(out.numel())).pow(2)
         if self.beta != 0.:
             h = self.raw_out[-1]
-            if len(h)>1: last_loss += (self.beta * (h[1:] - h[:-1]).pow(2).mean()).sum()
-        return last_loss
\ No newline at end of file
+            if len(h)>1: last_loss += self.beta * seq_diff_sq_mean(h)
+        #Adjusts the lr to the bptt selected for this step only, `on_step_end` puts it back
+        if self.adjust:
+            self.base_lr = self.learn.opt.lr
+            self.learn.opt.lr = self.base_lr * last_input.size(0) / self.bptt
+        return last_loss
+
+    def on_step_end(self, **kwargs):
+        if self.adjust: self.learn.opt.lr = self.base_lr
\ No newline at end of file
@@ -8,6 +8,11 @@ from forget_mult import ForgetMult
 ##Bradbury, James and Merity, Stephen and Xiong, Caiming and Socher, Richard 
 ##https://arxiv.org/abs/1611.01576
 
+# Scripted so the sigmoid and the product can be fused in one kernel on the GPU
+@torch.jit.script
+def qrnn_output_gate(O, C):
+    return torch.sigmoid(O) * C
+
 class QRNNLayer(nn.Module):
     r"""Applies a single layer Quasi-Recurrent Neural Network (QRNN) to an input sequence.
 
@@ -76,8 +81,9 @@ class QRNNLayer(nn.Module):
             Y = Y.view(seq_len, batch_size, 2 * self.hidden_size)
             Z, F = Y.chunk(2, dim=2)
         ###
-        Z.tanh_()
-        F.sigmoid_()
+        # Out of place, so the results are contiguous as the ForgetMult kernel expects
+        Z = torch.tanh(Z)
+        F = torch.sigmoid(F)
 
         # If zoneout is specified, we perform dropout on the forget gates in F
         # If an element of F is zero, that means the corresponding neuron keeps the old value
@@ -100,7 +106,7 @@ class QRNNLayer(nn.Module):
 
         # Apply (potentially optional) output gate
         if self.output_gate:
-            H = torch.sigmoid(O) * C
+            H = qrnn_output_gate(O, C)
         else:
             H = C
 
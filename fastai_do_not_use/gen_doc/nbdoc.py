@@ -1,6 +1,6 @@
 "`gen_doc.nbdoc` generates notebook documentation from module functions and links to correct places"
 
-import inspect,importlib,enum,os,re
+import inspect,importlib,enum,os,re,functools,typing
 from IPython.core.display import display, Markdown, HTML
 from typing import Dict, Any, AnyStr, List, Sequence, TypeVar, Tuple, Optional, Union
 from .docstrings import *
@@ -13,9 +13,23 @@ MODULE_NAME = 'fastai'
 SOURCE_URL = 'https://github.com/fastai/fastai_pytorch/blob/master/'
 PYTORCH_DOCS = 'https://pytorch.org/docs/stable/'
 _typing_names = {t:n for t,n in fastai_types.items() if t.__module__=='typing'}
+_ForwardRef = getattr(typing, 'ForwardRef', None) or typing._ForwardRef # renamed in python 3.7
+
+def cache_elt(func):
+    "Memoizes `func`, which only reflects on its arguments. Unhashable arguments aren't cached"
+    cached = functools.lru_cache(maxsize=None)(func)
+    @functools.wraps(func)
+    def _inner(*args, **kwargs):
+        try: return cached(*args, **kwargs)
+        except TypeError as e:
+            if 'unhashable' not in str(e): raise
+            return func(*args, **kwargs)
+    _inner.cache_clear = cached.cache_clear
+    return _inner
 
 def is_enum(cls): return cls == enum.Enum or cls == enum.EnumMeta
 
+@cache_elt
 def link_type(arg_type, arg_name=None, include_bt:bool=True):
     "creates link to documentation"
     arg_name = arg_name or fn_name(arg_type)
@@ -26,21 +40,29 @@ def link_type(arg_type, arg_name=None, include_bt:bool=True):
 
 def is_fastai_class(t): return belongs_to_module(t, MODULE_NAME)
 
+@cache_elt
 def belongs_to_module(t, module_name):
     "checks if belongs to module_name"
-    if not inspect.getmodule(t): return False
-    return inspect.getmodule(t).__name__.startswith(module_name)
+    mod = inspect.getmodule(t)
+    return mod is not None and mod.__name__.startswith(module_name)
 
 def code_esc(s): return f'`{s}`'
 
+_type_reprs = {}
 def type_repr(t):
+    "Memoizes `_type_repr` on the repr of `t`: typing makes `Union[int,str]` and `Union[str,int]` equal with the same hash"
+    key = (type(t), repr(t))
+    if key not in _type_reprs: _type_reprs[key] = _type_repr(t)
+    return _type_reprs[key]
+
+def _type_repr(t):
     if t in _typing_names: return link_type(t, _typing_names[t])
-    if hasattr(t, '__forward_arg__'): return link_type(t.__forward_arg__)
-    elif getattr(t, '__args__', None):
-        args = t.__args__
+    if isinstance(t, _ForwardRef): return link_type(t.__forward_arg__)
+    args = getattr(t, '__args__', None)
+    if args:
         if len(args)==2 and args[1] == type(None):
             return f'`Optional`\[{type_repr(args[0])}\]'
-        reprs = ', '.join([type_repr(o) for o in t.__args__])
+        reprs = ', '.join([type_repr(o) for o in args])
         return f'{link_type(t)}\[{reprs}\]'
     else: return link_type(t)
 
@@ -55,6 +77,7 @@ def format_param(p):
         res += f'=`{repr(default)}`'
     return res
 
+@cache_elt
 def format_ft_def(func, full_name:str=None)->str:
     "Formats and links function definition to show in documentation"
     sig = inspect.signature(func)
@@ -124,13 +147,11 @@ def link_docstring(modules, docstring:str, overwrite:bool=False) -> str:
     mods = listify(modules)
     modvars = {}
     for mod in mods: modvars.update(mod.__dict__) # concat all module definitions
-    for m in BT_REGEX.finditer(docstring):
+    def _link(m):
         keyword = m.group(1) or m.group(2)
         elt = find_elt(modvars, keyword)
-        if elt is None: continue
-        link = link_type(elt, arg_name=keyword)
-        docstring = docstring.replace(m.group(0), link) # group(0) = replace whole link with new one
-    return docstring
+        return m.group(0) if elt is None else link_type(elt, arg_name=keyword) # group(0) = replace whole link with new one
+    return BT_REGEX.sub(_link, docstring)
 
 def find_elt(modvars, keyword, match_last=True):
     "Attempts to resolve keywords such as Learner.lr_find. `match_last` starts matching from last component."
@@ -172,18 +193,17 @@ def get_ft_names(mod, include_inner=False)->List[str]:
     # If the module has an attribute __all__, it picks those.
     # Otherwise, it returns all the functions defined inside a module.
     fn_names = []
+    is_init,modvars = mod.__file__.endswith('__init__.py'),mod.__dict__
     for elt_name in get_exports(mod):
-        elt = getattr(mod,elt_name)
-        #This removes the files imported from elsewhere
-        try:    fname = inspect.getfile(elt)
-        except: continue
-        if mod.__file__.endswith('__init__.py'):
-            if inspect.ismodule(elt): fn_names.append(elt_name)
+        elt = modvars.get(elt_name)
+        if is_init:
+            if inspect.ismodule(elt) and hasattr(elt, '__file__'): fn_names.append(elt_name)
             else: continue
         else:
-            if (fname != mod.__file__): continue
-            if inspect.isclass(elt) or inspect.isfunction(elt): fn_names.append(elt_name)
-            else: continue
+            if not (inspect.isclass(elt) or inspect.isfunction(elt)): continue
+            #This removes the objects imported from elsewhere
+            if getattr(elt, '__module__', None) != mod.__name__: continue
+            fn_names.append(elt_name)
         if include_inner and inspect.isclass(elt) and not is_enum(elt.__class__):
             fn_names.extend(get_inner_fts(elt))
     return fn_names
@@ -248,6 +268,7 @@ def fn_name(ft)->str:
     elif hasattr(ft,'__origin__'): return str(ft.__origin__).split('.')[-1]
     else:                         return str(ft).split('.')[-1]
 
+@cache_elt
 def get_fn_link(ft) -> str:
     "returns function link to notebook documentation"
     strip_name = strip_fastai(get_module_name(ft))
@@ -256,6 +277,7 @@ def get_fn_link(ft) -> str:
 
 def get_module_name(ft) -> str: return ft.__name__ if inspect.ismodule(ft) else ft.__module__
 
+@cache_elt
 def get_pytorch_link(ft) -> str:
     "returns link to pytorch docs"
     name = ft.__name__
@@ -277,6 +299,7 @@ def get_source_link(mod, lineno) -> str:
     link = f"{SOURCE_URL}{github_path}.py#L{lineno}"
     return f'<a href="{link}">[source]</a>'
 
+@cache_elt
 def get_function_source(ft) -> str:
     "returns link to  line in source code"
     lineno = inspect.getsourcelines(ft)[1]